@@ -1,5 +1,5 @@
 #!/usr/bin/env bash
 set -e
 
-gunicorn -b 0.0.0.0:$PORT main:app &
-python bot_runner.py
+# health-check на $PORT поднимает сам бот (см. start_health_server в main.py)
+exec python bot_runner.py